@@ -0,0 +1,120 @@
+"""Micro-benchmarks for the routers.
+
+Run them with ``./run.sh bench``.  Each line is the time of one
+``db_for_read()`` or ``db_for_write()`` call in nanoseconds (best of several
+runs).
+
+To compare with another revision, such as a release tag, pass it to
+``--compare``::
+
+    ./run.sh bench --compare REV
+
+The revision is checked out in a temporary git worktree and both trees are
+benchmarked in fresh processes.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+NUMBER = 200000
+REPEAT = 5
+
+
+def bench(name, func):
+    best = min(timeit.repeat(func, number=NUMBER, repeat=REPEAT))
+    return name, best / NUMBER * 1e9
+
+
+def run():
+    """Benchmark the multidb found on sys.path, yielding (name, ns) pairs."""
+    import django
+    django.setup()
+
+    import multidb
+    from multidb.pinning import pin_this_thread, unpin_this_thread
+
+    replica_router = multidb.ReplicaRouter()
+    pinning_router = multidb.PinningReplicaRouter()
+    multidb.get_replica()
+
+    yield bench('ReplicaRouter', lambda: replica_router.db_for_read(None))
+    yield bench('ReplicaRouter, write',
+                lambda: replica_router.db_for_write(None))
+    yield bench('PinningReplicaRouter, never pinned',
+                lambda: pinning_router.db_for_read(None))
+    pin_this_thread()
+    yield bench('PinningReplicaRouter, pinned',
+                lambda: pinning_router.db_for_read(None))
+    unpin_this_thread()
+    yield bench('PinningReplicaRouter, unpinned',
+                lambda: pinning_router.db_for_read(None))
+
+    try:
+        from multidb.trace import trace_routing
+    except ImportError:
+        # Older revisions have no tracing.
+        return
+    with trace_routing():
+        yield bench('PinningReplicaRouter, traced',
+                    lambda: pinning_router.db_for_read(None))
+
+
+def run_in(path):
+    """Benchmark the tree at ``path`` in a new process; return {name: ns}.
+
+    The script runs from ``path`` so that its directory, first on sys.path,
+    supplies multidb and the settings.
+
+    """
+    script = os.path.join(path, os.path.basename(__file__))
+    if not os.path.exists(script):
+        shutil.copy(os.path.abspath(__file__), script)
+    out = subprocess.check_output([sys.executable, script, '--raw'],
+                                  cwd=path, universal_newlines=True)
+    return dict((name, float(ns)) for name, ns in
+                (line.rsplit('\t', 1) for line in out.splitlines()))
+
+
+def compare(rev):
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmp = tempfile.mkdtemp()
+    worktree = os.path.join(tmp, 'tree')
+    subprocess.check_call(['git', 'worktree', 'add', '-q', '--detach',
+                           worktree, rev], cwd=here)
+    try:
+        before = run_in(worktree)
+    finally:
+        subprocess.check_call(['git', 'worktree', 'remove', '--force',
+                               worktree], cwd=here)
+        shutil.rmtree(tmp, ignore_errors=True)
+    after = run_in(here)
+
+    print('%-36s %9s %9s' % ('', rev[:9], 'current'))
+    for name, ns in after.items():
+        old = '%6.0f ns' % before[name] if name in before else '-'
+        print('%-36s %9s %6.0f ns' % (name, old, ns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--compare', metavar='REV',
+                        help='also benchmark this git revision')
+    parser.add_argument('--raw', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+    elif args.raw:
+        for name, ns in run():
+            print('%s\t%f' % (name, ns))
+    else:
+        for name, ns in run():
+            print('%-36s %6.0f ns' % (name, ns))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,10 @@ Then put ``multidb.ReplicaRouter`` into DATABASE_ROUTERS::
 
 The replica databases will be chosen in round-robin fashion.
 
+If the replicas are spread over several zones, set ``MULTIDB_REPLICA_ZONES``
+and the ``MULTIDB_LOCAL_ZONE`` environment variable and reads will prefer the
+replicas in the local zone; see :mod:`multidb.locality`.
+
 If you want to get a connection to a replica in your app, use
 :func:`multidb.get_replica`::
 
@@ -27,13 +31,15 @@ If you want to get a connection to a replica in your app, use
 
     connection = connections[multidb.get_replica()]
 """
-import itertools
 import random
 import warnings
+import weakref
 
 from django.conf import settings
 
+from .locality import ReplicaCycle, locality_cycle
 from .pinning import this_thread_is_pinned, db_write  # noqa
+from .pinning import _locals as _pinning
 
 
 VERSION = (0, 11, 0)
@@ -44,6 +50,11 @@ DEFAULT_DB_ALIAS = 'default'
 
 replicas = None
 
+# Every router, so their hooks can follow tracing; see ReplicaRouter._hook().
+_routers = weakref.WeakSet()
+# Whether any thread is tracing routing; set by multidb.trace.
+_tracing = False
+
 
 def _get_replica_list():
     global replicas
@@ -67,7 +78,7 @@ def _get_replica_list():
             'You can configure them with the REPLICA_DATABASES setting.',
             UserWarning,
         )
-        replicas = itertools.repeat(DEFAULT_DB_ALIAS)
+        replicas = ReplicaCycle([DEFAULT_DB_ALIAS], [])
         return replicas
 
     # Shuffle the list so the first replica isn't slammed during startup.
@@ -77,13 +88,25 @@ def _get_replica_list():
     for db in dbs:
         settings.DATABASES[db].get('TEST', {})['MIRROR'] = DEFAULT_DB_ALIAS
 
-    replicas = itertools.cycle(dbs)
+    replicas = locality_cycle(dbs)
     return replicas
 
 
 def get_replica():
     """Returns the alias of a replica database."""
-    return next(_get_replica_list())
+    cycle = replicas or _get_replica_list()
+    db = next(cycle.local)
+    if cycle.unavailable:
+        db = cycle.available(db)
+    return db
+
+
+def _set_tracing(tracing):
+    """Install or remove the routers' tracing hooks."""
+    global _tracing
+    _tracing = tracing
+    for router in list(_routers):
+        router._hook()
 
 
 def get_slave():
@@ -107,7 +130,61 @@ class DeprecationMixin(object):
 
 
 class ReplicaRouter(object):
-    """Router that sends all reads to a replica, all writes to default."""
+    """Router that sends all reads to a replica, all writes to default.
+
+    :meth:`db_for_read` and :meth:`db_for_write` only route.  While a thread
+    traces routing, or when writes must invalidate cached reads, instance
+    attributes shadow them with hooked versions, so the hooks cost nothing
+    the rest of the time.
+
+    """
+    # The multidb.trace module while the tracing hooks are installed.
+    _trace = None
+    # multidb.cache.record_write, if writes invalidate cached reads.
+    _record_write = None
+
+    def __init__(self):
+        self._cache_writes = (
+            getattr(settings, 'MULTIDB_READ_CACHE', None) is not None)
+        if self._cache_writes:
+            # Imported here, since it pulls in django.db.models.
+            from .cache import record_write
+            self._record_write = record_write
+        _routers.add(self)
+        self._hook()
+
+    def _hook(self):
+        hooks = self.__dict__
+        if _tracing:
+            from . import trace
+            self._trace = trace
+            hooks['db_for_read'] = self._traced_db_for_read
+        else:
+            self._trace = None
+            hooks.pop('db_for_read', None)
+        if _tracing or self._cache_writes:
+            hooks['db_for_write'] = self._hooked_db_for_write
+        else:
+            hooks.pop('db_for_write', None)
+
+    def _read_reason(self, db):
+        return self._trace.STRATEGY
+
+    def _traced_db_for_read(self, model, **hints):
+        db = type(self).db_for_read(self, model, **hints)
+        trace = self._trace
+        if trace is not None:
+            trace.record_route(db, model, self._read_reason(db))
+        return db
+
+    def _hooked_db_for_write(self, model, **hints):
+        db = type(self).db_for_write(self, model, **hints)
+        if self._record_write is not None:
+            self._record_write(model)
+        trace = self._trace
+        if trace is not None:
+            trace.record_route(db, model, trace.DB_WRITE)
+        return db
 
     def db_for_read(self, model, **hints):
         """Send reads to replicas in round-robin."""
@@ -141,7 +218,13 @@ class PinningReplicaRouter(ReplicaRouter):
     def db_for_read(self, model, **hints):
         """Send reads to replicas in round-robin unless this thread is
         "stuck" to the master."""
-        return DEFAULT_DB_ALIAS if this_thread_is_pinned() else get_replica()
+        # Reads the flag this_thread_is_pinned() returns, without the call.
+        return DEFAULT_DB_ALIAS if _pinning.pinned else get_replica()
+
+    def _read_reason(self, db):
+        if this_thread_is_pinned():
+            return self._trace.PINNED
+        return self._trace.STRATEGY
 
 
 class MasterSlaveRouter(DeprecationMixin, ReplicaRouter):
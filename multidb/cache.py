@@ -0,0 +1,178 @@
+"""Caching of replica reads.
+
+Reads of hot, read-mostly models often return the same rows over and over.
+:class:`CachedQuerySet` keeps the results of replica reads in one of Django's
+caches.  Enable it by naming the cache in your settings::
+
+    MULTIDB_READ_CACHE = 'default'
+
+and use the queryset for the models you want to cache::
+
+    class Category(models.Model):
+        ...
+        cached = CachedQuerySet.as_manager()
+
+Every table read through a :class:`CachedQuerySet` has a write epoch, the
+time of its last write, which is part of the cache key.  When the router picks
+the database for a write to such a table, the epoch is moved: inside an atomic
+block, once it commits; otherwise right away, which is just *before* the write
+runs.  Results aren't cached while any of their tables was written to less
+than ``MULTIDB_PINNING_SECONDS`` ago.  That covers lagging replicas, and the
+write that follows the epoch in autocommit mode, as long as it is committed
+within that time.  Reads from the primary, including every read made while the
+thread is pinned, are never cached.
+"""
+from functools import partial
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Manager, QuerySet
+
+from . import _get_replica_list
+from .middleware import pinning_seconds
+from .pinning import this_thread_is_pinned
+
+
+__all__ = ['CachedQuerySet', 'bump_epoch']
+
+
+# Tables read through a CachedQuerySet, whose writes must move their epoch.
+_cached_tables = set()
+
+
+def read_cache():
+    """The alias of the cache holding replica reads, or None if reads aren't
+    cached."""
+    return getattr(settings, 'MULTIDB_READ_CACHE', None)
+
+
+def read_cache_seconds():
+    """The number of seconds for which a replica read is cached.
+
+    Defaults to ``MULTIDB_PINNING_SECONDS``, which should exceed the
+    replication lag.
+
+    """
+    return int(getattr(settings, 'MULTIDB_READ_CACHE_SECONDS',
+                       pinning_seconds()))
+
+
+def epoch_key(table):
+    return 'multidb:epoch:%s' % table
+
+
+def _set_epoch(table):
+    alias = read_cache()
+    if alias is not None:
+        caches[alias].set(epoch_key(table), time.time_ns(), None)
+
+
+def bump_epoch(model):
+    """Invalidate the cached reads of ``model``'s table.
+
+    Inside an atomic block on the primary, wait until it commits; otherwise
+    do it now.  Call it after writes the router doesn't see, like raw SQL.
+
+    """
+    if read_cache() is None:
+        return
+    table = model._meta.db_table
+    # on_commit() refuses to run outside atomic blocks when autocommit is off.
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        transaction.on_commit(partial(_set_epoch, table),
+                              using=DEFAULT_DB_ALIAS)
+    else:
+        _set_epoch(table)
+
+
+def record_write(model):
+    """Invalidate the cached reads of ``model``'s table, if it has any; see
+    :func:`bump_epoch`."""
+    if model is not None and model._meta.db_table in _cached_tables:
+        bump_epoch(model)
+
+
+def get_epochs(cache, tables):
+    """Return the current epochs of ``tables`` as a sorted list of pairs."""
+    keys = dict((epoch_key(t), t) for t in tables)
+    epochs = cache.get_many(keys)
+    for key in keys:
+        if key not in epochs:
+            # Missing or evicted: all we know is that it wasn't written to
+            # after now.
+            cache.add(key, time.time_ns(), None)
+            epochs[key] = cache.get(key)
+    return sorted((keys[k], v) for k, v in epochs.items())
+
+
+class CachedManager(Manager):
+    """A manager whose model's writes invalidate cached reads."""
+
+    def contribute_to_class(self, cls, name):
+        super(CachedManager, self).contribute_to_class(cls, name)
+        if not cls._meta.abstract:
+            _cached_tables.add(cls._meta.db_table)
+
+
+class CachedQuerySet(QuerySet):
+    """A QuerySet whose results are cached when they are read from a replica.
+
+    Only the tables joined in the query itself are tracked: writes to tables
+    that are only read in a subquery don't invalidate the cache before
+    ``MULTIDB_READ_CACHE_SECONDS`` have passed.  Other tables joined in the
+    query are tracked once this process has read them.
+
+    """
+    @classmethod
+    def as_manager(cls):
+        manager = CachedManager.from_queryset(cls)()
+        manager._built_with_as_manager = True
+        return manager
+    as_manager.queryset_only = True
+
+    def _fetch_all(self):
+        if self._result_cache is None:
+            alias = read_cache()
+            if alias is not None and not this_thread_is_pinned():
+                # self.db asks the router every time, and round-robin gives
+                # a different replica each time.  Fetch through a clone fixed
+                # to the one we got; this queryset must keep routing, or its
+                # writes and its pinned clones would go to the replica too.
+                db = self.db
+                if db != DEFAULT_DB_ALIAS:
+                    self._result_cache = self.using(db)._fetch_cached(
+                        caches[alias])
+        super(CachedQuerySet, self)._fetch_all()
+
+    def _fetch_cached(self, cache):
+        """Return the results through ``cache``, or None if the query can't
+        be cached."""
+        db = self.db
+        try:
+            sql, params = self.query.get_compiler(db).as_sql()
+        except EmptyResultSet:
+            return None
+        tables = set(t.table_name for t in self.query.alias_map.values())
+        tables.add(self.model._meta.db_table)
+        _cached_tables.update(tables)
+        epochs = get_epochs(cache, tables)
+        # Every replica returns the same rows, so they share cache entries,
+        # under None, which can't be an alias.
+        if db in _get_replica_list().aliases:
+            db = None
+        key = 'multidb:read:%s' % hashlib.sha1(repr((
+            db, self._iterable_class.__name__, self._fields, sql, params,
+            epochs,
+        )).encode('utf-8')).hexdigest()
+
+        results = cache.get(key)
+        if results is None:
+            results = list(self._iterable_class(self))
+            last_write = max(epoch for _, epoch in epochs)
+            if time.time_ns() - last_write >= pinning_seconds() * 10 ** 9:
+                cache.set(key, results, read_cache_seconds())
+        return results
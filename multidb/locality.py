@@ -0,0 +1,125 @@
+"""Zone-aware replica selection.
+
+If your replicas live in several availability zones, tell multidb which zone
+each one is in and which zone this process runs in, and reads will stay in the
+local zone::
+
+    MULTIDB_REPLICA_ZONES = {
+        'shadow-1': 'us-east-1a',
+        'shadow-2': 'us-east-1b',
+    }
+
+The local zone is read from the ``MULTIDB_LOCAL_ZONE`` environment variable
+(the name of the variable can be changed with the ``MULTIDB_LOCAL_ZONE_ENV``
+setting).  Remote replicas are only used when every local replica has been
+marked unavailable with :func:`mark_replica_unavailable`.  Without zones,
+replicas marked unavailable are skipped as long as another one is available.
+"""
+import itertools
+import os
+
+from django.conf import settings
+
+
+__all__ = ['local_zone', 'replica_zone', 'mark_replica_unavailable',
+           'mark_replica_available', 'replica_is_available']
+
+
+_unavailable = set()
+
+
+def local_zone_env():
+    """The name of the environment variable holding the local zone."""
+    return getattr(settings, 'MULTIDB_LOCAL_ZONE_ENV', 'MULTIDB_LOCAL_ZONE')
+
+
+def local_zone():
+    """Return the zone this process runs in, or None if it isn't known."""
+    return os.environ.get(local_zone_env()) or None
+
+
+def replica_zone(alias):
+    """Return the zone of the replica ``alias``, or None if it isn't known."""
+    return getattr(settings, 'MULTIDB_REPLICA_ZONES', {}).get(alias)
+
+
+def mark_replica_unavailable(alias):
+    """Stop sending reads to ``alias`` while other replicas are available.
+
+    Use this from health checks when a replica is down or saturated.
+
+    """
+    _unavailable.add(alias)
+
+
+def mark_replica_available(alias):
+    """Undo :func:`mark_replica_unavailable`.
+
+    If the replica wasn't marked, do nothing.
+
+    """
+    _unavailable.discard(alias)
+
+
+def replica_is_available(alias):
+    return alias not in _unavailable
+
+
+def _first_available(dbs, n):
+    """Return the first available alias among the next ``n`` of ``dbs``."""
+    for _ in range(n):
+        db = next(dbs)
+        if db not in _unavailable:
+            return db
+    return None
+
+
+class ReplicaCycle(object):
+    """Round-robin over replica aliases that prefers the local ones.
+
+    Local replicas are chosen in round-robin fashion; remote replicas are
+    chosen, also in round-robin, only when all the local ones are unavailable.
+    If every replica is unavailable the local ones are used anyway.
+
+    :func:`multidb.get_replica` takes the next alias from :attr:`local`, a
+    plain ``itertools.cycle`` that is safe to share between threads, and only
+    calls :meth:`available` while some replica is marked unavailable.
+
+    """
+    def __init__(self, local, remote):
+        self.local = itertools.cycle(local)
+        self.remote = itertools.cycle(remote)
+        self.num_local = len(local)
+        self.num_remote = len(remote)
+        self.aliases = frozenset(local) | frozenset(remote)
+        self.unavailable = _unavailable
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        db = next(self.local)
+        return self.available(db) if _unavailable else db
+
+    def available(self, db):
+        """Return ``db``, the local replica just picked, or the next available
+        replica if it is unavailable."""
+        if db not in _unavailable:
+            return db
+        return (_first_available(self.local, self.num_local - 1) or
+                _first_available(self.remote, self.num_remote) or db)
+
+
+def locality_cycle(dbs):
+    """Return a :class:`ReplicaCycle` over ``dbs``.
+
+    If the local zone is unknown or no replica is in it, all the replicas are
+    treated as local.
+
+    """
+    zone = local_zone()
+    local = [db for db in dbs if zone is not None and replica_zone(db) == zone]
+    if not local:
+        return ReplicaCycle(dbs, [])
+    remote = [db for db in dbs if db not in local]
+    return ReplicaCycle(local, remote)
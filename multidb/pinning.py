@@ -10,13 +10,20 @@ __all__ = ['this_thread_is_pinned', 'pin_this_thread', 'unpin_this_thread',
            'use_primary_db', 'use_master', 'db_write']
 
 
-_locals = threading.local()
+class _PinningState(threading.local):
+    # Class-level defaults keep reads of unset attributes off the slow
+    # AttributeError path of getattr() with a default.
+    pinned = False
+    old = False
+
+
+_locals = _PinningState()
 
 
 def this_thread_is_pinned():
     """Return whether the current thread should send all its reads to the
     master DB."""
-    return getattr(_locals, 'pinned', False)
+    return _locals.pinned
 
 
 def pin_this_thread():
@@ -1,9 +1,15 @@
+import os
+import sys
+import time
 import warnings
-from threading import Lock, Thread
+from threading import Barrier, Lock, Thread
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models, transaction
 from django.http import HttpRequest, HttpResponse
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 
 
 try:
@@ -13,8 +19,18 @@ except ImportError:
 
 # For deprecation tests
 import multidb
+import multidb.cache
+import multidb.locality
 import multidb.pinning
+import multidb.trace
 from multidb import DEFAULT_DB_ALIAS, PinningReplicaRouter, ReplicaRouter, get_replica
+from multidb.cache import CachedQuerySet
+from multidb.locality import (
+    local_zone,
+    mark_replica_available,
+    mark_replica_unavailable,
+    replica_zone,
+)
 from multidb.middleware import (
     PinningRouterMiddleware,
     pinning_cookie,
@@ -30,6 +46,17 @@ from multidb.pinning import (
     unpin_this_thread,
     use_primary_db,
 )
+from multidb.trace import RoutingTraceMiddleware, current_trace, trace_routing
+
+
+class Thing(models.Model):
+    name = models.CharField(max_length=20)
+
+    objects = models.Manager()
+    cached = CachedQuerySet.as_manager()
+
+    class Meta:
+        app_label = "multidb"
 
 
 class UnpinningTestCase(TestCase):
@@ -58,6 +85,87 @@ class ReplicaRouterTests(TestCase):
         assert not router.allow_migrate(get_replica(), "dummy")
 
 
+@override_settings(
+    REPLICA_DATABASES=["replica", "replica-east", "replica-west"],
+    MULTIDB_REPLICA_ZONES={
+        "replica": "east",
+        "replica-east": "east",
+        "replica-west": "west",
+    },
+)
+class LocalityTests(TestCase):
+    """Tests for zone-aware replica selection."""
+
+    def setUp(self):
+        multidb.replicas = None
+
+    def tearDown(self):
+        multidb.replicas = None
+        multidb.locality._unavailable.clear()
+
+    def picks(self, n=6):
+        return set(get_replica() for _ in range(n))
+
+    def test_zones(self):
+        self.assertEqual(replica_zone("replica-west"), "west")
+        self.assertEqual(replica_zone("default"), None)
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": "west"}):
+            self.assertEqual(local_zone(), "west")
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": ""}):
+            self.assertEqual(local_zone(), None)
+
+    @override_settings(MULTIDB_LOCAL_ZONE_ENV="AZ")
+    def test_zone_env_override(self):
+        with mock.patch.dict(os.environ, {"AZ": "east"}):
+            self.assertEqual(local_zone(), "east")
+
+    def test_no_local_zone(self):
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": ""}):
+            self.assertEqual(
+                self.picks(), set(["replica", "replica-east", "replica-west"])
+            )
+
+    def test_unknown_local_zone(self):
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": "north"}):
+            self.assertEqual(
+                self.picks(), set(["replica", "replica-east", "replica-west"])
+            )
+
+    def test_prefers_local(self):
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": "east"}):
+            self.assertEqual(self.picks(), set(["replica", "replica-east"]))
+
+    def test_skips_unavailable_local(self):
+        mark_replica_unavailable("replica")
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": "east"}):
+            self.assertEqual(self.picks(), set(["replica-east"]))
+
+    def test_spills_over_to_remote(self):
+        mark_replica_unavailable("replica")
+        mark_replica_unavailable("replica-east")
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": "east"}):
+            self.assertEqual(self.picks(), set(["replica-west"]))
+            mark_replica_available("replica-east")
+            self.assertEqual(self.picks(), set(["replica-east"]))
+
+    def test_unavailable_without_zones(self):
+        mark_replica_unavailable("replica")
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": ""}):
+            self.assertEqual(self.picks(), set(["replica-east", "replica-west"]))
+
+    @override_settings(MULTIDB_REPLICA_ZONES={})
+    def test_unavailable_unknown_zone(self):
+        mark_replica_unavailable("replica-west")
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": "east"}):
+            self.assertEqual(self.picks(), set(["replica", "replica-east"]))
+
+    def test_all_unavailable(self):
+        for db in ("replica", "replica-east", "replica-west"):
+            mark_replica_unavailable(db)
+        with mock.patch.dict(os.environ, {"MULTIDB_LOCAL_ZONE": "west"}):
+            self.assertEqual(self.picks(), set(["replica-west"]))
+
+
 class SettingsTests(TestCase):
     """Tests for default settings."""
 
@@ -209,6 +317,344 @@ class MiddlewareTests(UnpinningTestCase):
         assert pinning_cookie() in response.cookies
 
 
+class TraceTests(UnpinningTestCase):
+    """Tests for tracing routing decisions and queries."""
+
+    def setUp(self):
+        super(TraceTests, self).setUp()
+        self.model = mock.Mock()
+        self.model._meta.label = "app.Model"
+        self.request = HttpRequest()
+        self.request.method = "GET"
+        self.request.path = "/"
+        self.middleware = RoutingTraceMiddleware(mock.MagicMock())
+
+    def test_no_trace(self):
+        assert current_trace() is None
+        self.assertEqual(ReplicaRouter().db_for_read(None), get_replica())
+
+    def test_routes(self):
+        router = PinningReplicaRouter()
+        with trace_routing() as trace:
+            assert current_trace() is trace
+            router.db_for_read(self.model)
+            router.db_for_read(self.model)
+            router.db_for_write(None)
+            with use_primary_db:
+                router.db_for_read(self.model)
+        assert current_trace() is None
+        self.assertEqual(
+            dict((tuple(r), n) for r, n in trace.routes.items()),
+            {
+                (get_replica(), "app.Model", "strategy"): 2,
+                (DEFAULT_DB_ALIAS, None, "db_write"): 1,
+                (DEFAULT_DB_ALIAS, "app.Model", "pinned"): 1,
+            },
+        )
+        assert trace.summary().startswith(
+            "strategy=2 db_write=1 pinned=1 cookie=0 "
+        )
+        # Routing decisions alone aren't reads.
+        self.assertEqual(trace.pinned_reads(), 0)
+
+    def test_hooks_only_while_tracing(self):
+        router = PinningReplicaRouter()
+        assert "db_for_read" not in router.__dict__
+        assert "db_for_write" not in router.__dict__
+        with trace_routing():
+            assert "db_for_read" in router.__dict__
+            with trace_routing():
+                pass
+            assert "db_for_read" in router.__dict__
+            assert PinningReplicaRouter().db_for_read.__name__ == (
+                "_traced_db_for_read"
+            )
+        assert "db_for_read" not in router.__dict__
+        assert "db_for_write" not in router.__dict__
+
+    def test_queries(self):
+        with trace_routing() as trace:
+            connections[DEFAULT_DB_ALIAS].cursor().execute("SELECT 1")
+            connections[DEFAULT_DB_ALIAS].cursor().execute("SELECT 1")
+        connections[DEFAULT_DB_ALIAS].cursor().execute("SELECT 1")
+        self.assertEqual([q.alias for q in trace.queries], ["default", "default"])
+        assert trace.summary().startswith("default=2q/")
+        assert trace.summary().endswith(" pinned_reads=0")
+
+    def test_pinned_reads(self):
+        cursor = connections[DEFAULT_DB_ALIAS].cursor()
+        with trace_routing() as trace:
+            cursor.execute("SELECT 1")
+            with use_primary_db:
+                cursor.execute("SELECT 1")
+                cursor.execute("SAVEPOINT s")
+            cursor.execute("RELEASE SAVEPOINT s")
+        self.assertEqual(trace.pinned_reads(), 1)
+
+    @override_settings(DEBUG=True)
+    def test_header_in_debug(self):
+        self.request.COOKIES[pinning_cookie()] = "y"
+        self.middleware.process_request(self.request)
+        PinningReplicaRouter().db_for_read(None)
+        self.assertEqual(current_trace().reasons()["cookie"], 1)
+        connections[DEFAULT_DB_ALIAS].cursor().execute("SELECT 1")
+        response = self.middleware.process_response(self.request, HttpResponse())
+        header = response["X-Multidb-Trace"]
+        assert header.startswith("default=1q/"), header
+        assert header.endswith(
+            " strategy=0 db_write=0 pinned=0 cookie=1 pinned_reads=1"
+        ), header
+        assert current_trace() is None
+
+    @override_settings(DEBUG=True)
+    def test_header_with_open_trace(self):
+        """The header reports the request's trace, even if the view left
+        another one open."""
+        self.middleware.process_request(self.request)
+        connections[DEFAULT_DB_ALIAS].cursor().execute("SELECT 1")
+        inner = trace_routing()
+        inner.__enter__()
+        try:
+            response = self.middleware.process_response(
+                self.request, HttpResponse()
+            )
+        finally:
+            # Closing the inner trace restores the request's trace.
+            inner.__exit__(None, None, None)
+            multidb.trace._locals.trace = None
+        assert response["X-Multidb-Trace"].startswith("default=1q/")
+
+    @override_settings(DEBUG=False, MULTIDB_TRACE_SAMPLE_RATE=1)
+    def test_log_when_sampled(self):
+        self.middleware.process_request(self.request)
+        with self.assertLogs("multidb.trace", "INFO") as logs:
+            response = self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(
+            logs.output,
+            [
+                "INFO:multidb.trace:GET / "
+                "strategy=0 db_write=0 pinned=0 cookie=0 pinned_reads=0"
+            ],
+        )
+        assert "X-Multidb-Trace" not in response
+
+    @override_settings(DEBUG=False, MULTIDB_TRACE_SAMPLE_RATE=0)
+    def test_not_sampled(self):
+        self.middleware.process_request(self.request)
+        assert current_trace() is None
+        response = self.middleware.process_response(self.request, HttpResponse())
+        assert "X-Multidb-Trace" not in response
+
+
+@override_settings(
+    MULTIDB_READ_CACHE="default",
+    DATABASE_ROUTERS=["multidb.PinningReplicaRouter"],
+    # No replication lag, unless a test says otherwise.
+    MULTIDB_PINNING_SECONDS=0,
+    MULTIDB_READ_CACHE_SECONDS=60,
+)
+class ReadCacheTests(TransactionTestCase):
+    """Tests for caching replica reads.
+
+    The replica is a test mirror of the default database, so writes have to be
+    committed for its connection to see them.
+
+    """
+
+    databases = {"default", "replica", "replica-east"}
+
+    @classmethod
+    def setUpClass(cls):
+        # multidb has no models module, so the test database lacks the table.
+        with connections[DEFAULT_DB_ALIAS].schema_editor() as editor:
+            editor.create_model(Thing)
+        super(ReadCacheTests, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ReadCacheTests, cls).tearDownClass()
+        with connections[DEFAULT_DB_ALIAS].schema_editor() as editor:
+            editor.delete_model(Thing)
+
+    def setUp(self):
+        unpin_this_thread()
+        cache.clear()
+        Thing.objects.create(name="a")
+
+    def tearDown(self):
+        unpin_this_thread()
+        Thing.objects.all().delete()
+
+    def test_cached(self):
+        with self.assertNumQueries(1, using="replica"):
+            self.assertEqual([t.name for t in Thing.cached.all()], ["a"])
+            self.assertEqual([t.name for t in Thing.cached.all()], ["a"])
+        with self.assertNumQueries(1, using="replica"):
+            self.assertEqual(Thing.cached.values_list("name", flat=True)[0], "a")
+            self.assertEqual(Thing.cached.values_list("name", flat=True)[0], "a")
+        with self.assertNumQueries(1, using="replica"):
+            self.assertEqual(Thing.cached.get(name="a").name, "a")
+            self.assertEqual(Thing.cached.get(name="a").name, "a")
+        with self.assertNumQueries(1, using="replica"):
+            self.assertEqual(list(Thing.cached.values_list("name", flat=True)), ["a"])
+
+    def test_write_through_evaluated_queryset(self):
+        qs = Thing.cached.filter(name="a")
+        list(qs)
+        assert qs._db is None
+        with self.assertNumQueries(1, using="default"):
+            qs.update(name="z")
+        self.assertEqual(Thing.objects.using("default").get().name, "z")
+        pin_this_thread()
+        self.assertEqual(qs.filter(pk=1).db, DEFAULT_DB_ALIAS)
+
+    def test_one_route_per_read(self):
+        with trace_routing() as trace:
+            list(Thing.cached.all())
+        self.assertEqual(trace.reasons(), {"strategy": 1})
+
+    @override_settings(REPLICA_DATABASES=["replica", "replica-east"])
+    def test_shared_between_replicas(self):
+        multidb.replicas = None
+        try:
+            with CaptureQueriesContext(connections["replica"]) as one:
+                with CaptureQueriesContext(connections["replica-east"]) as two:
+                    for _ in range(4):
+                        self.assertEqual(
+                            [t.name for t in Thing.cached.all()], ["a"]
+                        )
+        finally:
+            multidb.replicas = None
+        self.assertEqual(len(one) + len(two), 1)
+
+    @override_settings(SLAVE_DATABASES=["replica", "replica-east"])
+    def test_shared_between_slaves(self):
+        del settings.REPLICA_DATABASES
+        multidb.replicas = None
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                with CaptureQueriesContext(connections["replica"]) as one:
+                    with CaptureQueriesContext(
+                        connections["replica-east"]
+                    ) as two:
+                        for _ in range(4):
+                            self.assertEqual(
+                                [t.name for t in Thing.cached.all()], ["a"]
+                            )
+        finally:
+            multidb.replicas = None
+        self.assertEqual(len(one) + len(two), 1)
+
+    @override_settings(REPLICA_DATABASES=["replica-east"])
+    def test_not_shared_with_other_databases(self):
+        multidb.replicas = None
+        try:
+            list(Thing.cached.all())
+            # "replica" isn't a replica here, so it has its own entries.
+            with self.assertNumQueries(1, using="replica"):
+                list(Thing.cached.using("replica"))
+        finally:
+            multidb.replicas = None
+
+    def test_not_cached(self):
+        with self.assertNumQueries(2, using="replica"):
+            list(Thing.objects.all())
+            list(Thing.objects.all())
+
+    @override_settings(MULTIDB_READ_CACHE=None)
+    def test_disabled(self):
+        with self.assertNumQueries(2, using="replica"):
+            list(Thing.cached.all())
+            list(Thing.cached.all())
+
+    def test_pinned(self):
+        pin_this_thread()
+        with self.assertNumQueries(2, using="default"):
+            list(Thing.cached.all())
+            list(Thing.cached.all())
+
+    def test_invalidated_by_save(self):
+        list(Thing.cached.all())
+        Thing.objects.create(name="b")
+        with self.assertNumQueries(1, using="replica"):
+            self.assertEqual(
+                sorted(t.name for t in Thing.cached.all()), ["a", "b"]
+            )
+
+    def test_invalidated_by_update(self):
+        list(Thing.cached.all())
+        Thing.objects.update(name="c")
+        with self.assertNumQueries(1, using="replica"):
+            self.assertEqual([t.name for t in Thing.cached.all()], ["c"])
+
+    def test_epoch_evicted(self):
+        list(Thing.cached.all())
+        cache.delete(multidb.cache.epoch_key(Thing._meta.db_table))
+        with self.assertNumQueries(1, using="replica"):
+            list(Thing.cached.all())
+
+    def test_invalidated_on_commit(self):
+        self.assertEqual([t.name for t in Thing.cached.all()], ["a"])
+        with transaction.atomic():
+            Thing.objects.create(name="b")
+            # Not committed, so the replica can't have it: keep the cache.
+            with self.assertNumQueries(0, using="replica"):
+                self.assertEqual([t.name for t in Thing.cached.all()], ["a"])
+        with self.assertNumQueries(1, using="replica"):
+            self.assertEqual(
+                sorted(t.name for t in Thing.cached.all()), ["a", "b"]
+            )
+
+    def test_manual_transaction(self):
+        list(Thing.cached.all())
+        transaction.set_autocommit(False)
+        try:
+            Thing.objects.create(name="b")
+            transaction.commit()
+        finally:
+            transaction.set_autocommit(True)
+        with self.assertNumQueries(1, using="replica"):
+            self.assertEqual(
+                sorted(t.name for t in Thing.cached.all()), ["a", "b"]
+            )
+
+    def test_rolled_back(self):
+        list(Thing.cached.all())
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Thing.objects.create(name="b")
+                raise ValueError
+        with self.assertNumQueries(0, using="replica"):
+            list(Thing.cached.all())
+
+    @override_settings(MULTIDB_PINNING_SECONDS=15)
+    def test_not_cached_within_lag(self):
+        # setUp() has just written to the table.
+        with self.assertNumQueries(2, using="replica"):
+            list(Thing.cached.all())
+            list(Thing.cached.all())
+
+    @override_settings(MULTIDB_PINNING_SECONDS=15)
+    def test_cached_after_lag(self):
+        cache.set(
+            multidb.cache.epoch_key(Thing._meta.db_table),
+            time.time_ns() - 20 * 10**9,
+            None,
+        )
+        with self.assertNumQueries(1, using="replica"):
+            list(Thing.cached.all())
+            list(Thing.cached.all())
+
+    def test_uncached_tables_not_bumped(self):
+        model = mock.Mock()
+        model._meta.db_table = "not_cached"
+        PinningReplicaRouter().db_for_write(model)
+        self.assertEqual(cache.get(multidb.cache.epoch_key("not_cached")), None)
+        PinningReplicaRouter().db_for_write(Thing)
+        assert cache.get(multidb.cache.epoch_key(Thing._meta.db_table))
+
+
 class UsePrimaryDBTests(TestCase):
     def test_decorator(self):
         @use_primary_db
@@ -301,6 +747,54 @@ class UsePrimaryDBTests(TestCase):
         self.assertEqual(pinned[1], False)
 
 
+@override_settings(REPLICA_DATABASES=["replica", "replica-east", "replica-west"])
+class ThreadedReplicaTests(TestCase):
+    """get_replica() is shared by every request thread."""
+
+    def setUp(self):
+        multidb.replicas = None
+
+    def tearDown(self):
+        multidb.replicas = None
+        multidb.locality._unavailable.clear()
+
+    def check_threads(self):
+        barrier = Barrier(8)
+        errors = []
+        picked = set()
+
+        def worker():
+            barrier.wait()
+            try:
+                for _ in range(20000):
+                    picked.add(get_replica())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=worker) for _ in range(8)]
+        # Switch threads as often as possible to provoke collisions.
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        return picked
+
+    def test_threaded_get_replica(self):
+        self.assertEqual(
+            self.check_threads(), set(["replica", "replica-east", "replica-west"])
+        )
+
+    def test_threaded_get_replica_unavailable(self):
+        mark_replica_unavailable("replica")
+        self.assertEqual(self.check_threads(), set(["replica-east", "replica-west"]))
+
+
 class DeprecationTestCase(TestCase):
     def test_masterslaverouter(self):
         with warnings.catch_warnings(record=True) as w:
@@ -0,0 +1,195 @@
+"""Per-request tracing of routing decisions and query timings.
+
+While a trace is active, the routers count the decisions they make by alias,
+model and reason (why that alias was chosen), and every query is timed per
+alias.  The summary shows how much work went where, why, and how many reads
+ran on the primary while the thread was pinned.
+
+Use :func:`trace_routing` as a context manager, or replace
+``PinningRouterMiddleware`` with :class:`RoutingTraceMiddleware`.
+"""
+from collections import Counter, namedtuple
+from contextlib import ExitStack, contextmanager
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from . import _set_tracing
+from .middleware import PinningRouterMiddleware, pinning_cookie
+from .pinning import this_thread_is_pinned
+
+
+__all__ = ['trace_routing', 'current_trace', 'record_route',
+           'RoutingTraceMiddleware']
+
+
+log = logging.getLogger('multidb.trace')
+
+# Why a router chose an alias.
+PINNED = 'pinned'
+COOKIE = 'cookie'
+DB_WRITE = 'db_write'
+STRATEGY = 'strategy'
+REASONS = (STRATEGY, DB_WRITE, PINNED, COOKIE)
+
+Route = namedtuple('Route', 'alias model reason')
+Query = namedtuple('Query', 'alias seconds pinned sql')
+
+
+class _TraceState(threading.local):
+    trace = None
+
+
+_locals = _TraceState()
+
+# The number of traces active in any thread.  The routers' tracing hooks are
+# installed while it isn't zero, which keeps untraced routing cheap.
+_active = 0
+_active_lock = threading.Lock()
+
+
+def trace_header():
+    """The response header carrying the trace summary in debug mode."""
+    return getattr(settings, 'MULTIDB_TRACE_HEADER', 'X-Multidb-Trace')
+
+
+def trace_sample_rate():
+    """The fraction of requests traced and logged when DEBUG is off."""
+    return float(getattr(settings, 'MULTIDB_TRACE_SAMPLE_RATE', 0.01))
+
+
+class RoutingTrace(object):
+    """The routing decisions and queries recorded in one trace."""
+
+    def __init__(self):
+        # Counts of Routes: there are only so many aliases, models and reasons,
+        # however many queries a request makes.
+        self.routes = Counter()
+        self.queries = []
+        # Reason recorded when a read goes to the primary because the thread
+        # is pinned; the middleware changes it when the pin came from a cookie.
+        self.pin_reason = PINNED
+
+    def route(self, alias, model, reason):
+        if reason == PINNED:
+            reason = self.pin_reason
+        label = model._meta.label if model is not None else None
+        self.routes[Route(alias, label, reason)] += 1
+
+    def execute(self, execute, sql, params, many, context):
+        """A database execute wrapper timing each query."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(Query(context['connection'].alias,
+                                      time.perf_counter() - start,
+                                      this_thread_is_pinned(), sql))
+
+    def pinned_reads(self):
+        """Return the number of SELECT queries run on the primary while the
+        thread was pinned."""
+        return sum(1 for q in self.queries
+                   if q.pinned and q.alias == DEFAULT_DB_ALIAS and
+                   q.sql.lstrip()[:6].upper() == 'SELECT')
+
+    def reasons(self):
+        """Return the number of routing decisions per reason."""
+        counts = Counter()
+        for route, n in self.routes.items():
+            counts[route.reason] += n
+        return counts
+
+    def summary(self):
+        """Return a one-line summary of queries and time per alias, routing
+        decisions per reason and pinned reads, e.g. ``default=2q/1.3ms
+        replica=5q/4.0ms strategy=5 db_write=1 pinned=0 cookie=2
+        pinned_reads=2``."""
+        counts, times = {}, {}
+        for q in self.queries:
+            counts[q.alias] = counts.get(q.alias, 0) + 1
+            times[q.alias] = times.get(q.alias, 0) + q.seconds
+        parts = ['%s=%dq/%.1fms' % (alias, counts[alias], times[alias] * 1000)
+                 for alias in sorted(counts)]
+        reasons = self.reasons()
+        parts.extend('%s=%d' % (reason, reasons[reason]) for reason in REASONS)
+        parts.append('pinned_reads=%d' % self.pinned_reads())
+        return ' '.join(parts)
+
+
+def current_trace():
+    """Return the trace active in this thread, or None."""
+    return _locals.trace
+
+
+def record_route(alias, model, reason):
+    """Record a routing decision in the active trace, if any, and return
+    ``alias``."""
+    trace = _locals.trace
+    if trace is not None:
+        trace.route(alias, model, reason)
+    return alias
+
+
+@contextmanager
+def trace_routing():
+    """Trace routing decisions and queries made by this thread in the block.
+
+    Yields the :class:`RoutingTrace`.
+
+    """
+    global _active
+    old = current_trace()
+    trace = _locals.trace = RoutingTrace()
+    with _active_lock:
+        _active += 1
+        if _active == 1:
+            _set_tracing(True)
+    try:
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(
+                    connections[alias].execute_wrapper(trace.execute))
+            yield trace
+    finally:
+        with _active_lock:
+            _active -= 1
+            if _active == 0:
+                _set_tracing(False)
+        _locals.trace = old
+
+
+class RoutingTraceMiddleware(PinningRouterMiddleware):
+    """PinningRouterMiddleware that also traces each request.
+
+    In debug mode every request is traced and the summary is sent in a
+    response header.  Otherwise a sample of requests is traced and the summary
+    is logged to the ``multidb.trace`` logger.
+
+    """
+    def process_request(self, request):
+        if settings.DEBUG or random.random() < trace_sample_rate():
+            stack = ExitStack()
+            trace = stack.enter_context(trace_routing())
+            request._multidb_trace = (stack, trace)
+            if pinning_cookie() in request.COOKIES:
+                trace.pin_reason = COOKIE
+        return super(RoutingTraceMiddleware, self).process_request(request)
+
+    def process_response(self, request, response):
+        response = super(RoutingTraceMiddleware, self).process_response(
+            request, response)
+        if not hasattr(request, '_multidb_trace'):
+            return response
+        stack, trace = request._multidb_trace
+        stack.close()
+        del request._multidb_trace
+        if settings.DEBUG:
+            response[trace_header()] = trace.summary()
+        else:
+            log.info('%s %s %s', request.method, request.path, trace.summary())
+        return response
@@ -8,6 +8,7 @@ usage() {
     echo "  test - run the tests"
     echo "  shell - open the Django shell"
     echo "  check - run flake8"
+    echo "  bench - run the micro-benchmarks"
     exit 1
 }
 
@@ -18,6 +19,9 @@ case "$1" in
         django-admin shell ;;
     "check" )
         flake8 multidb ;;
+    "bench" )
+        shift
+        python benchmarks.py "$@" ;;
     * )
         usage ;;
 esac
@@ -1,6 +1,8 @@
 # A Django settings module to support the tests
 
 SECRET_KEY = 'dummy'
+INSTALLED_APPS = ['multidb']
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware'
@@ -15,12 +17,27 @@ DATABASES = {
     'replica': {
         'NAME': 'replica.sqlite',
         'ENGINE': 'django.db.backends.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
+    'replica-east': {
+        'NAME': 'replica-east.sqlite',
+        'ENGINE': 'django.db.backends.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
+    'replica-west': {
+        'NAME': 'replica-west.sqlite',
+        'ENGINE': 'django.db.backends.sqlite3',
+        'TEST': {'MIRROR': 'default'},
     },
 }
 
 # Put the aliases for replica databases in this list.
 REPLICA_DATABASES = ['replica']
 
+# If the replicas are spread over zones, map each alias to its zone and set
+# the MULTIDB_LOCAL_ZONE environment variable to prefer the local ones:
+# MULTIDB_REPLICA_ZONES = {'replica-east': 'east', 'replica-west': 'west'}
+
 # If you use PinningReplicaRouter and its associated middleware, you can
 # customize the cookie name and its lifetime like so:
 # MULTIDB_PINNING_COOKIE = "multidb_pin_writes"